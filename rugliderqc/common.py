@@ -1,19 +1,34 @@
 #!/usr/bin/env python
 
 import os
-import pytz
-from dateutil import parser
+import argparse
+import stat
+from datetime import datetime, timezone
+from functools import lru_cache
+from rugliderqc.loggers import setup_logger, logfile_deploymentname
 
 
-def find_glider_deployment_datapath(logger, deployment, deployments_root, dataset_type, cdm_data_type, mode):
-    #logger.info('Checking deployment {:s}'.format(deployment))
+@lru_cache(maxsize=4096)
+def _isdir_cached(path):
+    # the deployment directory tree doesn't change during a QC run, so only stat each path once
+    try:
+        return stat.S_ISDIR(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+@lru_cache(maxsize=1024)
+def _deployment_datapath(deployment, deployments_root, dataset_type, cdm_data_type, mode):
+    # Build and check the deployment paths. Log messages are returned as (level, message) tuples instead of being
+    # logged here so the result can be cached for the QC scripts that run on the same deployment
+    messages = []
 
     try:
         (glider, trajectory) = deployment.split('-')
         try:
-            trajectory_dt = parser.parse(trajectory).replace(tzinfo=pytz.UTC)
+            trajectory_dt = datetime.strptime(trajectory, '%Y%m%dT%H%M').replace(tzinfo=timezone.utc)
         except ValueError as e:
-            logger.error('Error parsing trajectory date {:s}: {:}'.format(trajectory, e))
+            messages.append(('error', 'Error parsing trajectory date {:s}: {:}'.format(trajectory, e)))
             trajectory_dt = None
             data_path = None
             deployment_location = None
@@ -24,26 +39,36 @@ def find_glider_deployment_datapath(logger, deployment, deployments_root, datase
 
             # Create fully-qualified path to the deployment location
             deployment_location = os.path.join(deployments_root, deployment_name)
-            #logger.info('Deployment location: {:s}'.format(deployment_location))
-            if os.path.isdir(deployment_location):
-                # Set the deployment netcdf data path
-                data_path = os.path.join(deployment_location, 'data', 'out', 'nc',
-                                         '{:s}-{:s}/{:s}'.format(dataset_type, cdm_data_type, mode))
-                #logger.info('Data path: {:s}'.format(data_path))
-                if not os.path.isdir(data_path):
-                    logger.warning('{:s} data directory not found: {:s}'.format(trajectory, data_path))
-                    data_path = None
-                    deployment_location = None
-            else:
-                logger.warning('Deployment location does not exist: {:s}'.format(deployment_location))
+
+            # Set the deployment netcdf data path
+            data_path = os.path.join(deployment_location, 'data', 'out', 'nc',
+                                     '{:s}-{:s}/{:s}'.format(dataset_type, cdm_data_type, mode))
+
+            # a single stat of the data path covers the deployment location too, only check the deployment location
+            # to find out which warning to log if the data path isn't there
+            if not _isdir_cached(data_path):
+                if _isdir_cached(deployment_location):
+                    messages.append(('warning', '{:s} data directory not found: {:s}'.format(trajectory, data_path)))
+                else:
+                    messages.append(('warning', 'Deployment location does not exist: {:s}'.format(deployment_location)))
                 data_path = None
                 deployment_location = None
 
     except ValueError as e:
-        logger.error('Error parsing invalid deployment name {:s}: {:}'.format(deployment, e))
+        messages.append(('error', 'Error parsing invalid deployment name {:s}: {:}'.format(deployment, e)))
         data_path = None
         deployment_location = None
 
+    return data_path, deployment_location, tuple(messages)
+
+
+def find_glider_deployment_datapath(logger, deployment, deployments_root, dataset_type, cdm_data_type, mode):
+    #logger.info('Checking deployment {:s}'.format(deployment))
+    data_path, deployment_location, messages = _deployment_datapath(deployment, deployments_root, dataset_type,
+                                                                    cdm_data_type, mode)
+    for level, message in messages:
+        getattr(logger, level)(message)
+
     return data_path, deployment_location
 
 
@@ -53,13 +78,101 @@ def find_glider_deployments_rootdir(logger):
     if not data_home:
         logger.error('GLIDER_DATA_HOME_TEST not set')
         return 1, 1
-    elif not os.path.isdir(data_home):
+    elif not _isdir_cached(data_home):
         logger.error('Invalid GLIDER_DATA_HOME_TEST: {:s}'.format(data_home))
         return 1, 1
 
     deployments_root = os.path.join(data_home, 'deployments')
-    if not os.path.isdir(deployments_root):
+    if not _isdir_cached(deployments_root):
         logger.warning('Invalid deployments root: {:s}'.format(deployments_root))
         return 1, 1
 
     return data_home, deployments_root
+
+
+def setup_deployment(logger, deployment, deployments_root, dataset_type, cdm_data_type, mode, loglevel):
+    """
+    Find the deployment data path and set up the deployment logger in the deployment proc-logs directory. Returns
+    (data_path, deployment_location, deployment logger), or (None, None, None) if the deployment can't be processed.
+    :param logger: base logger used when the deployment logger can't be set up
+    :param deployment: glider deployment name formatted as glider-YYYYmmddTHHMM
+    :param deployments_root: glider deployments root directory
+    :param dataset_type: dataset type (e.g. sci)
+    :param cdm_data_type: cdm data type (e.g. profile)
+    :param mode: deployment dataset status (e.g. rt)
+    :param loglevel: logging level
+    """
+    data_path, deployment_location = find_glider_deployment_datapath(logger, deployment, deployments_root,
+                                                                     dataset_type, cdm_data_type, mode)
+
+    if not data_path:
+        logger.error('{:s} data directory not found:'.format(deployment))
+        return None, None, None
+
+    if not _isdir_cached(os.path.join(deployment_location, 'proc-logs')):
+        logger.error('{:s} deployment proc-logs directory not found:'.format(deployment))
+        return None, None, None
+
+    logfilename = logfile_deploymentname(deployment, dataset_type, cdm_data_type, mode)
+    logFile = os.path.join(deployment_location, 'proc-logs', logfilename)
+    deployment_logger = setup_logger('logging', loglevel, logFile)
+
+    return data_path, deployment_location, deployment_logger
+
+
+def find_queue_ncfiles(data_path):
+    """
+    List the netcdf files in the queue directory of a deployment data path, sorted by filename. Uses os.scandir, which
+    reads the directory entries (and their file types) in one pass instead of glob's fnmatch and per-entry stat.
+    :param data_path: deployment netcdf data path
+    """
+    try:
+        with os.scandir(os.path.join(data_path, 'queue')) as entries:
+            return sorted(e.path for e in entries if e.name.endswith('.nc') and not e.name.startswith('.')
+                          and e.is_file())
+    except FileNotFoundError:
+        return []
+
+
+def build_arg_parser(description=None):
+    """
+    Build the command line argument parser shared by the QC scripts
+    :param description: description shown in the help message
+    """
+    arg_parser = argparse.ArgumentParser(description=description,
+                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    arg_parser.add_argument('deployments',
+                            nargs='+',
+                            help='Glider deployment name(s) formatted as glider-YYYYmmddTHHMM')
+
+    arg_parser.add_argument('-m', '--mode',
+                            help='Deployment dataset status',
+                            choices=['rt', 'delayed'],
+                            default='rt')
+
+    arg_parser.add_argument('--level',
+                            choices=['sci', 'ngdac'],
+                            default='sci',
+                            help='Dataset type')
+
+    arg_parser.add_argument('-d', '--cdm_data_type',
+                            help='Dataset type',
+                            choices=['profile'],
+                            default='profile')
+
+    arg_parser.add_argument('-l', '--loglevel',
+                            help='Verbosity level',
+                            type=str,
+                            choices=['debug', 'info', 'warning', 'error', 'critical'],
+                            default='info')
+
+    arg_parser.add_argument('-w', '--workers',
+                            help='Number of files to process in parallel (threads for the netcdf reads and file '
+                                 'moves, processes for the CTD hysteresis test). Defaults to the number of CPUs, '
+                                 'and up to 32 threads for the file moves. Use 1 if the netcdf-c/HDF5 build is not '
+                                 'thread-safe',
+                            type=int,
+                            default=None)
+
+    return arg_parser
@@ -22,14 +22,23 @@ def logfile_deploymentname(deployment, dataset_type, cdm_data_type, mode):
 def setup_logger(name, loglevel, logfile):
     logger = logging.getLogger(name)
 
+    # the same logger name is reused for each deployment, so only keep the handler if it's already writing to this
+    # logfile. Otherwise close the previous deployment's handler so records aren't written to the wrong file and the
+    # file descriptors don't pile up
+    logfile = os.path.abspath(logfile)
+    if [h.baseFilename for h in logger.handlers if isinstance(h, logging.FileHandler)] != [logfile]:
+        for h in list(logger.handlers):
+            logger.removeHandler(h)
+            h.close()
+
     # if the logger doesn't already exist, set it up
     if not logger.handlers:
         log_format = logging.Formatter('%(asctime)s%(module)s:%(levelname)s:%(message)s [line %(lineno)d]')
         handler = logging.FileHandler(logfile)
         handler.setFormatter(log_format)
-
-        log_level = getattr(logging, loglevel)
-        logger.setLevel(log_level)
         logger.addHandler(handler)
+        logger.propagate = False
+
+    logger.setLevel(getattr(logging, loglevel))
 
     return logger
@@ -8,13 +8,117 @@ of another file.
 """
 
 import os
-import argparse
 import sys
-import glob
+import json
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import xarray as xr
-from rugliderqc.common import find_glider_deployment_datapath, find_glider_deployments_rootdir
-from rugliderqc.loggers import logfile_basename, setup_logger, logfile_deploymentname
+import netCDF4
+from rugliderqc.common import find_glider_deployments_rootdir, setup_deployment, find_queue_ncfiles, build_arg_parser
+from rugliderqc.loggers import logfile_basename, setup_logger
+
+
+def read_times(ncfile):
+    """
+    Read only the time variable from a netcdf file, skipping the CF decoding of the full dataset
+    :param ncfile: netcdf file
+    """
+    with netCDF4.Dataset(ncfile) as nc:
+        # read the raw values, skipping the masked array and scale/offset conversions
+        time_var = nc.variables['time']
+        time_var.set_auto_maskandscale(False)
+        times = np.ascontiguousarray(time_var[:])
+
+    # timestamps are only compared for equality, so reinterpret 8-byte values as int64 (zero-copy) for the comparisons
+    if times.dtype.itemsize == 8:
+        times = times.view('i8')
+
+    return times
+
+
+def try_read_times(ncfile):
+    """
+    Read the time variable from a netcdf file, returning the error instead of raising it so files can be read in
+    parallel and the errors logged afterwards
+    :param ncfile: netcdf file
+    """
+    try:
+        return read_times(ncfile), None
+    except OSError as e:
+        return None, e
+
+
+def is_subset(a, b):
+    """
+    Check if all of the values in a are found in b. Glider timestamps are already sorted within a file, so use a
+    binary search into b instead of the hashing/sorting that np.isin does, and fall back to np.isin when b isn't sorted
+    :param a: array of values to look for
+    :param b: array of values to search
+    """
+    if len(a) == 0:
+        return True
+    if len(b) == 0:
+        return False
+    if np.all(b[1:] >= b[:-1]):
+        idx = np.minimum(np.searchsorted(b, a), len(b) - 1)
+        return bool(np.all(b[idx] == a))
+    return bool(np.isin(a, b).all())
+
+
+def find_duplicate(f1, t1, f2, t2):
+    """
+    Compare the timestamps of two consecutive files and return the file that is a full duplicate of all or part of
+    the other file, or None if neither file is a duplicate
+    :param f1: first netcdf file
+    :param t1: timestamps in the first file
+    :param f2: second netcdf file
+    :param t2: timestamps in the second file
+    """
+    # most duplicates are exact copies, check for that first before any membership tests
+    if t1.shape == t2.shape and np.array_equal(t1, t2):
+        return f2
+
+    # check if all of the timestamps in each dataset are found in the other dataset
+    ds_in_ds2 = is_subset(t1, t2)
+    ds2_in_ds = is_subset(t2, t1)
+
+    # if all timestamps are found in both datasets (i.e. timestamps are exactly the same)
+    # rename the second dataset
+    if ds_in_ds2 and ds2_in_ds:
+        return f2
+    # if the second dataset is a subset of the first dataset, rename it
+    elif not ds_in_ds2 and ds2_in_ds:
+        return f2
+    # if the first dataset is a subset of the second dataset, rename it
+    elif ds_in_ds2 and not ds2_in_ds:
+        return f1
+    else:
+        return None
+
+
+def file_signature(ncfile):
+    """
+    Return the (modification time, size) of a file used to tell if it changed since the last run, None if the file
+    can't be stat'ed
+    :param ncfile: netcdf file
+    """
+    try:
+        st = os.stat(ncfile)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def load_checked_files(cache_file):
+    """
+    Load the files checked on previous runs from the JSON cache file, formatted as
+    {file: {'signature': [mtime_ns, size], 'next': next file compared or None}}
+    :param cache_file: JSON cache file
+    """
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
 
 
 def main(args):
@@ -38,80 +142,87 @@ def main(args):
         for deployment in args.deployments:
         # for deployment in [deployments]:
 
-            data_path, deployment_location = find_glider_deployment_datapath(logging_base, deployment, deployments_root,
-                                                                             dataset_type, cdm_data_type, mode)
-
+            data_path, deployment_location, logging = setup_deployment(logging_base, deployment, deployments_root,
+                                                                       dataset_type, cdm_data_type, mode, loglevel)
             if not data_path:
-                logging_base.error('{:s} data directory not found:'.format(deployment))
-                continue
-
-            if not os.path.isdir(os.path.join(deployment_location, 'proc-logs')):
-                logging_base.error('{:s} deployment proc-logs directory not found:'.format(deployment))
                 continue
 
-            logfilename = logfile_deploymentname(deployment, dataset_type, cdm_data_type, mode)
-            logFile = os.path.join(deployment_location, 'proc-logs', logfilename)
-            logging = setup_logger('logging', loglevel, logFile)
-
             logging.info('Checking duplicated timestamps: {:s}'.format(os.path.join(data_path, 'queue')))
 
             # List the netcdf files in queue
-            ncfiles = sorted(glob.glob(os.path.join(data_path, 'queue', '*.nc')))
+            ncfiles = find_queue_ncfiles(data_path)
 
             if len(ncfiles) == 0:
                 logging.error(' 0 files found to check: {:s}'.format(os.path.join(data_path, 'queue')))
                 status = 1
                 continue
 
-            # Iterate through files and find duplicated timestamps
+            # Files (and their neighbors) that haven't changed since the last run were already compared
+            cache_file = os.path.join(deployment_location, 'proc-logs', '.qc_cache.json')
+            checked_files = load_checked_files(cache_file)
+            signatures = [file_signature(f) for f in ncfiles]
+            unchanged = [sig is not None and checked_files.get(f, {}).get('signature') == sig
+                         for f, sig in zip(ncfiles, signatures)]
+            pair_checked = [unchanged[i] and unchanged[i + 1] and checked_files[f].get('next') == ncfiles[i + 1]
+                            for i, f in enumerate(ncfiles[:-1])]
+            pair_checked.append(True)  # the last file doesn't have a next file to compare to
+
+            # only read the files that are part of a pair that needs to be compared
+            read_idx = [i for i in range(len(ncfiles)) if not pair_checked[i] or (i > 0 and not pair_checked[i - 1])]
+
+            # Iterate through the files and compare each file's timestamps with the previous file. The timestamps are
+            # read in parallel threads (one per CPU by default, -w 1 reads serially for netcdf-c builds that
+            # aren't thread-safe), and each file's timestamps are carried forward
+            # to compare to the next file so every file is only read once. The duplicated files are renamed after
+            # all of the comparisons are done
+            duplicate_files = []
+            renamed = set()  # keep track of the duplicates in memory instead of relying on the rename failing
+            read_errors = set()
+            compared = list(pair_checked)
+            with ThreadPoolExecutor(max_workers=args.workers or os.cpu_count()) as executor:
+                file_times = executor.map(try_read_times, [ncfiles[i] for i in read_idx])
+                prev_i, prev_times = None, None
+                for i, (times, e) in zip(read_idx, file_times):
+                    if times is None:
+                        logging.error('Error reading file {:s} ({:})'.format(ncfiles[i], e))
+                        read_errors.add(i)
+                        status = 1
+
+                    # compare with the previous file if both files were read and the pair wasn't already checked
+                    if prev_i == i - 1 and not pair_checked[prev_i] and prev_times is not None and times is not None:
+                        compared[prev_i] = True
+                        duplicate = find_duplicate(ncfiles[prev_i], prev_times, ncfiles[i], times)
+                        if duplicate and duplicate not in renamed:
+                            duplicate_files.append(duplicate)
+                            renamed.add(duplicate)
+
+                    prev_i, prev_times = i, times
+
+            # Rename the duplicated files in one pass
             duplicates = 0
-            for i, f in enumerate(ncfiles):
+            for df in duplicate_files:
                 try:
-                    ds = xr.open_dataset(f)
-                except OSError as e:
-                    logging.error('Error reading file {:s} ({:})'.format(ncfiles[i], e))
+                    os.rename(df, f'{df}.duplicate')
+                except FileNotFoundError:
+                    logging.error('Duplicated file no longer found in queue: {:s}'.format(df))
                     status = 1
                     continue
+                logging.info('Duplicated timestamps found in file: {:s}'.format(df))
+                duplicates += 1
 
-                # find the next file and compare timestamps
-                try:
-                    f2 = ncfiles[i + 1]
-                    ds2 = xr.open_dataset(f2)
-                except OSError as e:
-                    logging.error('Error reading file {:s} ({:})'.format(ncfiles[i + 1], e))
-                    status = 1
-                    continue
-                except IndexError:
-                    continue
-
-                # find the unique timestamps between the two datasets
-                unique_timestamps = list(set(ds.time.values).symmetric_difference(set(ds2.time.values)))
-
-                # find the unique timestamps in each dataset
-                check_ds = [t for t in ds.time.values if t in unique_timestamps]
-                check_ds2 = [t for t in ds2.time.values if t in unique_timestamps]
-
-                # if the unique timestamps aren't found in either dataset (i.e. timestamps are exactly the same)
-                # rename the second dataset
-                if np.logical_and(len(check_ds) == 0, len(check_ds2) == 0):
-                    os.rename(f2, f'{f2}.duplicate')
-                    logging.info('Duplicated timestamps found in file: {:s}'.format(f2))
-                    duplicates += 1
-                # if the unique timestamps aren't found in the second dataset, rename it
-                elif np.logical_and(len(check_ds) > 0, len(check_ds2) == 0):
-                    os.rename(f2, f'{f2}.duplicate')
-                    logging.info('Duplicated timestamps found in file: {:s}'.format(f2))
-                    duplicates += 1
-                # if the unique timestamps aren't found in the first dataset, rename it
-                elif np.logical_and(len(check_ds) == 0, len(check_ds2) > 0):
-                    try:
-                        os.rename(f, f'{f}.duplicate')
-                        logging.info('Duplicated timestamps found in file: {:s}'.format(f))
-                        duplicates += 1
-                    except FileNotFoundError:  # file has already been identified as a duplicate
-                        continue
-                else:
+            # Save the files that were checked for the next run, replacing the previous entries for this queue
+            queue_dir = os.path.join(data_path, 'queue')
+            checked_files = {k: v for k, v in checked_files.items() if os.path.dirname(k) != queue_dir}
+            for i, f in enumerate(ncfiles):
+                if f in renamed or signatures[i] is None or i in read_errors:
                     continue
+                next_file = ncfiles[i + 1] if compared[i] and i + 1 < len(ncfiles) else None
+                checked_files[f] = {'signature': signatures[i], 'next': next_file}
+            try:
+                with open(cache_file, 'w') as cf:
+                    json.dump(checked_files, cf)
+            except OSError as e:
+                logging.warning('Error saving checked files cache {:s} ({:})'.format(cache_file, e))
 
             logging.info(' {:} duplicated files found (of {:} total files)'.format(duplicates, len(ncfiles)))
         return status
@@ -124,33 +235,7 @@ if __name__ == '__main__':
     # ll = 'info'
     # level = 'sci'
     # main(deploy, mode, d, ll, level)
-    arg_parser = argparse.ArgumentParser(description=main.__doc__,
-                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-
-    arg_parser.add_argument('deployments',
-                            nargs='+',
-                            help='Glider deployment name(s) formatted as glider-YYYYmmddTHHMM')
-
-    arg_parser.add_argument('-m', '--mode',
-                            help='Deployment dataset status',
-                            choices=['rt', 'delayed'],
-                            default='rt')
-
-    arg_parser.add_argument('--level',
-                            choices=['sci', 'ngdac'],
-                            default='sci',
-                            help='Dataset type')
-
-    arg_parser.add_argument('-d', '--cdm_data_type',
-                            help='Dataset type',
-                            choices=['profile'],
-                            default='profile')
-
-    arg_parser.add_argument('-l', '--loglevel',
-                            help='Verbosity level',
-                            type=str,
-                            choices=['debug', 'info', 'warning', 'error', 'critical'],
-                            default='info')
+    arg_parser = build_arg_parser(description=main.__doc__)
 
     parsed_args = arg_parser.parse_args()
 
@@ -8,55 +8,140 @@ variable.
 """
 
 import os
-import argparse
+import re
 import sys
-import glob
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import netCDF4
 import xarray as xr
-from shapely.geometry import Polygon, MultiPolygon
-from shapely.ops import polygonize
 from ioos_qc import qartod
 from ioos_qc.utils import load_config_as_dict as loadconfig
-from rugliderqc.common import find_glider_deployment_datapath, find_glider_deployments_rootdir
-from rugliderqc.loggers import logfile_basename, setup_logger, logfile_deploymentname
+from rugliderqc.common import find_glider_deployments_rootdir, setup_deployment, find_queue_ncfiles, build_arg_parser
+from rugliderqc.loggers import logfile_basename, setup_logger
 np.set_printoptions(suppress=True)
 
+# CTD instrument variable listed in the conductivity ancillary_variables attribute
+_CTD_RE = re.compile(r'(\S*instrument_ctd\S*)')
+
+# QC variable attributes that don't depend on the file
+_FLAG_VALUES = np.array([1, 2, 3, 4, 9], dtype=np.int8)
+_VALID_MIN = np.int8(1)
+_VALID_MAX = np.int8(9)
+_HYSTERESIS_ATTRS = {
+    'comment': 'Test for CTD sensor lag, determined by comparing the area between profile pairs normalized to '
+               'pressure range against the data range times defined thresholds found in flag_configurations.',
+    'long_name': 'CTD Hysteresis Test Quality Flag',
+    'flag_values': _FLAG_VALUES,
+    'flag_meanings': 'GOOD UNKNOWN SUSPECT FAIL MISSING',
+    'valid_min': _VALID_MIN,
+    'valid_max': _VALID_MAX,
+}
+
 
 def apply_qartod_qc(dataset, cond_varname):
+    # apply QARTOD QC flags to conductivity, returns the conductivity values and the number of non-NaN values
+    qartod_vars = [x for x in dataset.data_vars if f'{cond_varname}_qartod' in x]
+    if not qartod_vars:
+        # no QARTOD flags to apply, conductivity is only read from here on so the copy isn't needed
+        cond = dataset[cond_varname]
+        return cond, int(np.count_nonzero(~np.isnan(cond.values)))
+
     # make a copy of conductivity and apply QARTOD QC flags
-    cond_copy = dataset[cond_varname].copy()
-    for qv in [x for x in dataset.data_vars if f'{cond_varname}_qartod' in x]:
-        qv_idx = np.where(np.logical_or(dataset[qv].values == 3, dataset[qv].values == 4))[0]
-        cond_copy[qv_idx] = np.nan
-    return cond_copy
+    cond_copy = dataset[cond_varname].astype('float64', copy=True)
+    # build one mask of the values flagged SUSPECT (3) or FAIL (4) by any of the QARTOD tests
+    flags = np.stack([dataset[qv].values for qv in qartod_vars])
+    bad = np.logical_or(flags == 3, flags == 4).any(axis=0)
+    # count the remaining data while the NaNs are set, values already NaN may also be flagged
+    n_valid = int(np.count_nonzero(~np.logical_or(bad, np.isnan(cond_copy.data))))
+    cond_copy.data[bad] = np.nan
+    return cond_copy, n_valid
 
 
 def initialize_flags(dataset, cond_varname):
-    # start with flag values UNKNOWN (2)
-    flags = 2 * np.ones(np.shape(dataset[cond_varname].values))
+    # identify where conductivity is nan once, and reuse the mask for the flags and the data indices
+    missing = np.isnan(dataset[cond_varname].values)
 
-    # identify where not nan
-    non_nan_ind = np.invert(np.isnan(dataset[cond_varname].values))
-    # get locations of non-nans
-    non_nan_i = np.where(non_nan_ind)[0]
+    # start with flag values UNKNOWN (2) and flag the missing values, flags are saved as bytes so build them as int8
+    flags = np.full(missing.shape, qartod.QartodFlags.UNKNOWN, dtype=np.int8)
+    flags[missing] = qartod.QartodFlags.MISSING
 
-    # flag the missing values
-    flags[np.invert(non_nan_ind)] = qartod.QartodFlags.MISSING
+    # get locations of non-nans
+    non_nan_i = np.flatnonzero(~missing)
 
     # identify where pressure is not nan
-    press_non_nan_ind = np.where(np.invert(np.isnan(dataset.pressure.values)))[0]
+    press_non_nan_ind = np.flatnonzero(~np.isnan(dataset.pressure.values))
 
     return non_nan_i, press_non_nan_ind, flags
 
 
-def save_ds(dataset, flag_array, attributes, variable_name, save_file, cond_varname):
-    # Add QC variable to the original dataset
-    da = xr.DataArray(flag_array, coords=dataset[cond_varname].coords, dims=dataset[cond_varname].dims,
-                      name=variable_name, attrs=attributes)
-    dataset[variable_name] = da
+def profile_pair_area(cond1, pres1, cond2, pres2):
+    """
+    Calculate the area between two profiles (e.g. a down and up profile pair). Both profiles are interpolated onto
+    the pressure values from both profiles within the pressure range where the profiles overlap, and the absolute
+    difference between the profiles is integrated over pressure. The pressures where the profiles cross are added to
+    the grid, so the piecewise linear difference is integrated exactly. Returns 0 if the profiles don't overlap.
+    :param cond1: conductivity values of the first profile
+    :param pres1: pressure values of the first profile
+    :param cond2: conductivity values of the second profile
+    :param pres2: pressure values of the second profile
+    """
+    if len(pres1) == 0 or len(pres2) == 0:
+        return 0.
+
+    # np.interp needs increasing pressure values
+    idx1 = np.argsort(pres1, kind='stable')
+    idx2 = np.argsort(pres2, kind='stable')
+    pres1, cond1 = pres1[idx1], cond1[idx1]
+    pres2, cond2 = pres2[idx2], cond2[idx2]
+
+    pmin = max(pres1[0], pres2[0])
+    pmax = min(pres1[-1], pres2[-1])
+    if pmax <= pmin:
+        return 0.
+
+    pgrid = np.unique(np.concatenate((pres1, pres2)))
+    pgrid = pgrid[np.logical_and(pgrid >= pmin, pgrid <= pmax)]
+    cond_diff = np.interp(pgrid, pres1, cond1) - np.interp(pgrid, pres2, cond2)
+
+    # add the pressures where the profiles cross (the difference changes sign), otherwise the trapezoid rule on the
+    # absolute difference overestimates the area of those intervals
+    cross = np.flatnonzero(cond_diff[:-1] * cond_diff[1:] < 0)
+    if len(cross) > 0:
+        d_a = cond_diff[cross]
+        d_b = cond_diff[cross + 1]
+        pcross = pgrid[cross] + (pgrid[cross + 1] - pgrid[cross]) * d_a / (d_a - d_b)
+        pgrid = np.insert(pgrid, cross + 1, pcross)
+        cond_diff = np.insert(cond_diff, cross + 1, 0.)
+    cond_diff = np.abs(cond_diff)
+
+    # trapezoid rule written out, np.trapz was removed from newer NumPy versions
+    return np.sum(np.diff(pgrid) * (cond_diff[1:] + cond_diff[:-1]) / 2)
+
+
+def load_profile(ncfile, cond_varname):
+    """
+    Load only the variables used by the test (conductivity, the conductivity QARTOD flags and pressure) instead of
+    the full dataset
+    :param ncfile: netcdf file
+    :param cond_varname: conductivity variable name
+    """
+    with xr.open_dataset(ncfile) as ds:
+        keep_vars = [cond_varname, 'pressure'] + [x for x in ds.data_vars if f'{cond_varname}_qartod' in x]
+        return ds[keep_vars].load()
+
 
-    # Save the resulting netcdf file with QC variable
-    dataset.to_netcdf(save_file)
+def save_ds(flag_array, attributes, variable_name, save_file, cond_varname):
+    # Append the QC variable to the original netcdf file in place instead of rewriting the whole file, on the same
+    # dimensions as the conductivity variable
+    with netCDF4.Dataset(save_file, 'a') as nc:
+        if variable_name in nc.variables:
+            qc_var = nc.variables[variable_name]
+        else:
+            qc_var = nc.createVariable(variable_name, 'b', nc.variables[cond_varname].dimensions,
+                                       fill_value=np.byte(-127))
+        qc_var[:] = flag_array.astype('b')
+        for key, value in attributes.items():
+            qc_var.setncattr(key, value)
 
 
 def set_hysteresis_attrs(test, sensor, thresholds=None):
@@ -68,24 +153,10 @@ def set_hysteresis_attrs(test, sensor, thresholds=None):
     """
     thresholds = thresholds or None
 
-    flag_meanings = 'GOOD UNKNOWN SUSPECT FAIL MISSING'
-    flag_values = [1, 2, 3, 4, 9]
-    standard_name = f'{test}_quality_flag'
-    long_name = 'CTD Hysteresis Test Quality Flag'
-    comment = 'Test for CTD sensor lag, determined by comparing the area between profile pairs normalized to ' \
-              'pressure range against the data range times defined thresholds found in flag_configurations.'
-
-    # Defining QC variable attributes
-    attrs = {
-        'comment': comment,
-        'standard_name': standard_name,
-        'long_name': long_name,
-        'flag_values': np.byte(flag_values),
-        'flag_meanings': flag_meanings,
-        'valid_min': np.byte(min(flag_values)),
-        'valid_max': np.byte(max(flag_values)),
-        'qc_target': sensor,
-    }
+    # Defining QC variable attributes, starting from the attributes that are the same for every file
+    attrs = _HYSTERESIS_ATTRS.copy()
+    attrs['standard_name'] = f'{test}_quality_flag'
+    attrs['qc_target'] = sensor
 
     if thresholds:
         attrs['flag_configurations'] = str(thresholds)
@@ -93,6 +164,170 @@ def set_hysteresis_attrs(test, sensor, thresholds=None):
     return attrs
 
 
+def read_cf_values(nc_var):
+    """
+    Read a netCDF4 variable as float64 values decoded the same way xarray does: only the _FillValue and missing_value
+    values are set to NaN (netCDF4's auto-mask also masks values outside valid_min/valid_max) before applying
+    scale_factor and add_offset
+    :param nc_var: netCDF4 variable
+    """
+    nc_var.set_auto_maskandscale(False)
+    raw = nc_var[:]
+    values = raw.astype('float64')
+    for attr in ('_FillValue', 'missing_value'):
+        if attr in nc_var.ncattrs():
+            fill = np.asarray(nc_var.getncattr(attr))
+            values[np.isin(raw, fill)] = np.nan
+    if 'scale_factor' in nc_var.ncattrs():
+        values *= nc_var.getncattr('scale_factor')
+    if 'add_offset' in nc_var.ncattrs():
+        values += nc_var.getncattr('add_offset')
+
+    return values
+
+
+def read_profile_info(ncfile, cond_varname):
+    """
+    Read the information needed to pair the down and up profiles before running the test: whether the file has
+    conductivity data, the CTD instrument listed in the conductivity ancillary_variables, and the first and last
+    non-NaN pressure values. The CTD instrument is None if it isn't found, and the pressure values are None if there
+    isn't any valid pressure data. Only the conductivity and pressure variables are read with netCDF4, without
+    opening and decoding the full dataset.
+    :param ncfile: netcdf file
+    :param cond_varname: conductivity variable name
+    """
+    with netCDF4.Dataset(ncfile) as nc:
+        info = dict(has_variable=cond_varname in nc.variables, has_data=False, ctd_instrument=None,
+                    pressure_start=None, pressure_end=None)
+        if info['has_variable']:
+            # Find the instrument to which the conductivity variable is associated
+            cond_var = nc.variables[cond_varname]
+            ancillary_variables = cond_var.getncattr('ancillary_variables') \
+                if 'ancillary_variables' in cond_var.ncattrs() else ''
+            m = _CTD_RE.search(ancillary_variables)
+            if m:
+                info['ctd_instrument'] = m.group(1)
+            conductivity = read_cf_values(nc.variables[cond_varname])
+            info['has_data'] = bool(np.any(~np.isnan(conductivity)))
+            pressure = read_cf_values(nc.variables['pressure'])
+            pressure = pressure[~np.isnan(pressure)]
+            if len(pressure) > 0:
+                info['pressure_start'] = pressure[0]
+                info['pressure_end'] = pressure[-1]
+
+    return info
+
+
+def run_hysteresis_test(ncfile, ncfile2, cond_varname, ctd_instrument, hysteresis_thresholds):
+    """
+    Run the CTD hysteresis test on a down and up profile pair and save the flags to both files. If there is no second
+    file, the flag values are left as UNKNOWN (2) and only the first file is saved. Returns the number of unknown,
+    suspect and failed files.
+    :param ncfile: netcdf file of the down profile
+    :param ncfile2: netcdf file of the up profile, or None
+    :param cond_varname: conductivity variable name
+    :param ctd_instrument: CTD instrument the conductivity variable is associated with (from the first file)
+    :param hysteresis_thresholds: flag thresholds from the QC configuration file
+    """
+    cv = cond_varname
+    unknown_files = 0
+    suspect_files = 0
+    failed_files = 0
+
+    ds = load_profile(ncfile, cv)
+
+    qc_varname = f'{ctd_instrument}_hysteresis_test'
+    kwargs = dict()
+    kwargs['thresholds'] = hysteresis_thresholds
+    attrs = set_hysteresis_attrs(qc_varname, cv, **kwargs)
+    data_idx, pressure_idx, flag_vals = initialize_flags(ds, cv)
+
+    if ncfile2 is None:
+        # the profile can't be paired, leave flag values as UNKNOWN (2), set the attributes and save the .nc file
+        save_ds(flag_vals, attrs, qc_varname, ncfile, cv)
+        return 1, 0, 0
+
+    ds2 = load_profile(ncfile2, cv)
+
+    data_idx2, pressure_idx2, flag_vals2 = initialize_flags(ds2, cv)
+
+    # first profile is down and second profile is up
+    # determine if the end/start timestamps are < 5 minutes apart,
+    # indicating a paired yo (down-up profile pair)
+    if ds2.time.values[0] - ds.time.values[-1] < np.timedelta64(5, 'm'):
+
+        # make a copy of conductivity and apply QARTOD QC flags
+        conductivity_copy, n_valid = apply_qartod_qc(ds, cv)
+        conductivity_copy2, n_valid2 = apply_qartod_qc(ds2, cv)
+
+        # both yos must have data remaining after QARTOD flags are applied,
+        # otherwise, test can't be run and leave the flag values as UNKNOWN (2)
+        if n_valid > 0 and n_valid2 > 0:
+            # calculate the area between the two profiles, dropping values where conductivity or pressure is NaN
+            cond1 = conductivity_copy.values
+            pres1 = ds.pressure.values
+            good1 = ~np.logical_or(np.isnan(cond1), np.isnan(pres1))
+            cond1, pres1 = cond1[good1], pres1[good1]
+            cond2 = conductivity_copy2.values
+            pres2 = ds2.pressure.values
+            good2 = ~np.logical_or(np.isnan(cond2), np.isnan(pres2))
+            cond2, pres2 = cond2[good2], pres2[good2]
+            cond_pair = np.concatenate((cond1, cond2))
+            pres_pair = np.concatenate((pres1, pres2))
+
+            # If the profile depth range is >5 dbar, run the test. Otherwise leave flags UNKNOWN (2)
+            # since hysteresis can't be determined with a profile that doesn't span a substantial
+            # depth range (e.g. usually hovering at the surface or bottom)
+
+            # convert negative pressure values to 0
+            pressure_copy = np.maximum(pres_pair, 0)
+            # the NaNs were already dropped from the pair, so use a single peak-to-peak pass
+            pressure_range = np.ptp(pressure_copy)
+            if pressure_range > 5:
+                # integrate the area between the profiles directly rather than building and
+                # polygonizing a self-intersecting polygon of the profile pair
+                area = profile_pair_area(cond1, pres1, cond2, pres2)
+
+                # normalize area between the profiles to the pressure range
+                area = area / pressure_range
+                data_range = np.ptp(cond_pair)
+
+                # Flag failed profiles
+                if area > data_range * hysteresis_thresholds['fail_threshold']:
+                    flag = qartod.QartodFlags.FAIL
+                    failed_files += 2
+                # Flag suspect profiles
+                elif area > data_range * hysteresis_thresholds['suspect_threshold']:
+                    flag = qartod.QartodFlags.SUSPECT
+                    suspect_files += 2
+                # Otherwise, both profiles are good
+                else:
+                    flag = qartod.QartodFlags.GOOD
+                flag_vals[data_idx] = flag
+                flag_vals2[data_idx2] = flag
+
+            # save both .nc files with hysteresis flag applied
+            # (or flag values = UNKNOWN (2) if the profile depth range is <5 dbar)
+            save_ds(flag_vals, attrs, qc_varname, ncfile, cv)
+            save_ds(flag_vals2, attrs, qc_varname, ncfile2, cv)
+            if 2. in flag_vals:
+                unknown_files += 2
+
+        else:
+            # if there is no data left after QARTOD tests are applied, leave flag values UNKNOWN (2)
+            save_ds(flag_vals, attrs, qc_varname, ncfile, cv)
+            save_ds(flag_vals2, attrs, qc_varname, ncfile2, cv)
+            unknown_files += 2
+    else:
+        # if timestamps are too far apart they're likely not from the same profile pair
+        # leave flag values as UNKNOWN (2), set the attributes and save the .nc files
+        save_ds(flag_vals, attrs, qc_varname, ncfile, cv)
+        save_ds(flag_vals2, attrs, qc_varname, ncfile2, cv)
+        unknown_files += 2
+
+    return unknown_files, suspect_files, failed_files
+
+
 def main(args):
 # def main(deployments, mode, cdm_data_type, loglevel, dataset_type):
     status = 0
@@ -120,21 +355,11 @@ def main(args):
         for deployment in args.deployments:
         # for deployment in [deployments]:
 
-            data_path, deployment_location = find_glider_deployment_datapath(logging_base, deployment, deployments_root,
-                                                                             dataset_type, cdm_data_type, mode)
-
+            data_path, deployment_location, logging = setup_deployment(logging_base, deployment, deployments_root,
+                                                                       dataset_type, cdm_data_type, mode, loglevel)
             if not data_path:
-                logging_base.error('{:s} data directory not found:'.format(deployment))
                 continue
 
-            if not os.path.isdir(os.path.join(deployment_location, 'proc-logs')):
-                logging_base.error('{:s} deployment proc-logs directory not found:'.format(deployment))
-                continue
-
-            logfilename = logfile_deploymentname(deployment, dataset_type, cdm_data_type, mode)
-            logFile = os.path.join(deployment_location, 'proc-logs', logfilename)
-            logging = setup_logger('logging', loglevel, logFile)
-
             logging.info('Checking for CTD sensor lag: {:s}'.format(os.path.join(data_path, 'queue')))
 
             # Set the deployment qc configuration path
@@ -158,173 +383,114 @@ def main(args):
             hysteresis_thresholds = config_dict['ctd_hysteresis_test']
 
             # List the netcdf files
-            ncfiles = sorted(glob.glob(os.path.join(data_path, 'queue', '*.nc')))
+            ncfiles = find_queue_ncfiles(data_path)
 
             if len(ncfiles) == 0:
                 logging.error(' 0 files found to QC: {:s}'.format(os.path.join(data_path, 'queue')))
                 status = 1
                 continue
 
-            conductivity_varnames = ['conductivity']
-
-            # Iterate through the possible conductivity variables
+            # the test is only run on conductivity, if more variables are added keep them explicit
+            cv = 'conductivity'
             failed_files = 0
             suspect_files = 0
             unknown_files = 0
-            for cv in conductivity_varnames:
 
-                # Iterate through files
-                skip = 0
-                for i, f in enumerate(ncfiles):
-                    i += skip
-                    try:
-                        with xr.open_dataset(ncfiles[i]) as ds:
-                            ds = ds.load()
-                    except OSError as e:
-                        logging.error('Error reading file {:s} ({:})'.format(ncfiles[i], e))
-                        status = 1
-                        continue
-                    except IndexError:
-                        continue
+            # Read the profile information for all of the files first to pair the down and up profiles
+            profile_info = []
+            for f in ncfiles:
+                try:
+                    profile_info.append(read_profile_info(f, cv))
+                except OSError as e:
+                    logging.error('Error reading file {:s} ({:})'.format(f, e))
+                    status = 1
+                    profile_info.append(None)
+
+            # Pair each down profile with the following up profile. Files that can't be paired are still
+            # processed by themselves so flag values are set to UNKNOWN (2)
+            pairs = []
+            i = 0
+            while i < len(ncfiles):
+                f = ncfiles[i]
+                info = profile_info[i]
+                i += 1
+                if info is None:
+                    continue
 
-                    try:
-                        ds[cv]
-                    except KeyError:
-                        logging.error('conductivity variable not found in file {:s})'.format(ncfiles[i]))
-                        status = 1
-                        continue
+                if not info['has_variable']:
+                    logging.error('conductivity variable not found in file {:s})'.format(f))
+                    status = 1
+                    continue
+
+                if not info['has_data']:
+                    logging.error('conductivity data not found in file {:s})'.format(f))
+                    status = 1
+                    continue
+
+                if info['ctd_instrument'] is None:
+                    # skip only this file, the next file can still be the first file of a pair
+                    logging.error('CTD instrument not found in {:s} ancillary_variables: {:s}'.format(cv, f))
+                    status = 1
+                    continue
 
-                    # Find the instrument to which the conductivity variable is associated
-                    ctd_instrument = [x for x in ds[cv].ancillary_variables.split(' ') if 'instrument_ctd' in x][0]
+                # determine if profile is up or down
+                if info['pressure_start'] is None or info['pressure_start'] > info['pressure_end']:
+                    # if profile is up (or has no pressure data), test can't be run because you need a down profile
+                    # paired with an up profile
+                    pairs.append((f, None, info['ctd_instrument']))
+                    continue
 
-                    qc_varname = f'{ctd_instrument}_hysteresis_test'
-                    kwargs = dict()
-                    kwargs['thresholds'] = hysteresis_thresholds
-                    attrs = set_hysteresis_attrs(qc_varname, cv, **kwargs)
-                    data_idx, pressure_idx, flag_vals = initialize_flags(ds, cv)
+                # first profile is down, check the next file
+                try:
+                    f2 = ncfiles[i]
+                except IndexError:
+                    # if there are no more files, leave flag values on the first file as UNKNOWN (2)
+                    pairs.append((f, None, info['ctd_instrument']))
+                    continue
 
-                    if len(data_idx) == 0:
-                        logging.error('conductivity data not found in file {:s})'.format(ncfiles[i]))
+                info2 = profile_info[i]
+                if info2 is None:
+                    # the next file couldn't be read (already logged), and can't be the first file of a pair
+                    pairs.append((f, None, info['ctd_instrument']))
+                    i += 1
+                    continue
+
+                if not info2['has_variable']:
+                    logging.error('conductivity variable not found in file {:s})'.format(f2))
+                    status = 1
+                    # TODO should we be checking the next file? example ru30_20210510T015902Z_sbd.nc
+                    # leave flag values on the first file as UNKNOWN (2)
+                    pairs.append((f, None, info['ctd_instrument']))
+                    continue
+
+                # determine if second profile is up or down
+                if info2['pressure_start'] is None or info2['pressure_start'] < info2['pressure_end']:
+                    # if second profile is also down, test can't be run on the first file
+                    # leave flag values on the first file as UNKNOWN (2)
+                    # but don't skip because this second file will now be the first file in the next loop
+                    pairs.append((f, None, info['ctd_instrument']))
+                    continue
+
+                pairs.append((f, f2, info['ctd_instrument']))
+                i += 1
+
+            # Run the test on the profile pairs in parallel, each pair is independent once the files are paired. The
+            # workers are separate processes, so the netcdf-c thread-safety concern doesn't apply and all of the CPUs
+            # are used by default
+            with ProcessPoolExecutor(max_workers=args.workers or os.cpu_count()) as executor:
+                futures = [executor.submit(run_hysteresis_test, f, f2, cv, ctd_instrument, hysteresis_thresholds)
+                           for f, f2, ctd_instrument in pairs]
+                for (f, f2, ctd_instrument), future in zip(pairs, futures):
+                    try:
+                        unknown, suspect, failed = future.result()
+                    except Exception as e:
+                        logging.error('Error running CTD hysteresis test on file(s) {:s} ({:})'.format(
+                            ' '.join(x for x in (f, f2) if x), e))
                         status = 1
                         continue
-
-                    # determine if profile is up or down
-                    if ds.pressure.values[pressure_idx][0] > ds.pressure.values[pressure_idx][-1]:
-                        # if profile is up, test can't be run because you need a down profile paired with an up profile
-                        # leave flag values as UNKNOWN (2), set the attributes and save the .nc file
-                        save_ds(ds, flag_vals, attrs, qc_varname, ncfiles[i], cv)
-                        unknown_files += 1
-                    else:  # first profile is down, check the next file
-                        try:
-                            f2 = ncfiles[i + 1]
-                            with xr.open_dataset(f2) as ds2:
-                                ds2 = ds2.load()
-                        except OSError as e:
-                            logging.error('Error reading file {:s} ({:})'.format(f2, e))
-                            status = 1
-                            skip += 1
-                        except IndexError:
-                            # if there are no more files, leave flag values on the first file as UNKNOWN (2)
-                            # set the attributes and save the first .nc file
-                            save_ds(ds, flag_vals, attrs, qc_varname, ncfiles[i], cv)
-                            unknown_files += 1
-                            continue
-
-                        try:
-                            ds2[cv]
-                        except KeyError:
-                            logging.error('conductivity variable not found in file {:s})'.format(f2))
-                            status = 1
-                            # TODO should we be checking the next file? example ru30_20210510T015902Z_sbd.nc
-                            # leave flag values on the first file as UNKNOWN (2), set the attributes and save the first .nc file
-                            save_ds(ds, flag_vals, attrs, qc_varname, ncfiles[i], cv)
-                            unknown_files += 1
-                            continue
-
-                        data_idx2, pressure_idx2, flag_vals2 = initialize_flags(ds2, cv)
-
-                        # determine if second profile is up or down
-                        if ds2.pressure.values[pressure_idx2][0] < ds2.pressure.values[pressure_idx2][-1]:
-                            # if second profile is also down, test can't be run on the first file
-                            # leave flag values on the first file as UNKNOWN (2), set the attributes and save the first .nc file
-                            # but don't skip because this second file will now be the first file in the next loop
-                            save_ds(ds, flag_vals, attrs, qc_varname, ncfiles[i], cv)
-                            unknown_files += 1
-                        else:
-                            # first profile is down and second profile is up
-                            # determine if the end/start timestamps are < 5 minutes apart,
-                            # indicating a paired yo (down-up profile pair)
-                            if ds2.time.values[0] - ds.time.values[-1] < np.timedelta64(5, 'm'):
-
-                                # make a copy of conductivity and apply QARTOD QC flags
-                                conductivity_copy = apply_qartod_qc(ds, cv)
-                                conductivity_copy2 = apply_qartod_qc(ds2, cv)
-
-                                # both yos must have data remaining after QARTOD flags are applied,
-                                # otherwise, test can't be run and leave the flag values as UNKNOWN (2)
-                                if np.logical_and(np.sum(~np.isnan(conductivity_copy)) > 0, np.sum(~np.isnan(conductivity_copy2)) > 0):
-                                    # calculate the area between the two profiles
-                                    df = conductivity_copy.to_dataframe().merge(ds.pressure.to_dataframe(), on='time')
-                                    df2 = conductivity_copy2.to_dataframe().merge(ds2.pressure.to_dataframe(), on='time')
-                                    df = df.append(df2)
-                                    df = df.dropna(subset=['pressure', cv])
-
-                                    # If the profile depth range is >5 dbar, run the test. Otherwise leave flags UNKNOWN (2)
-                                    # since hysteresis can't be determined with a profile that doesn't span a substantial
-                                    # depth range (e.g. usually hovering at the surface or bottom)
-
-                                    # convert negative pressure values to 0
-                                    pressure_copy = df.pressure.values.copy()
-                                    pressure_copy[pressure_copy < 0] = 0
-                                    pressure_range = (np.nanmax(pressure_copy) - np.nanmin(pressure_copy))
-                                    if pressure_range > 5:
-                                        polygon_points = df.values.tolist()
-                                        polygon_points.append(polygon_points[0])
-                                        polygon = Polygon(polygon_points)
-                                        polygon_lines = polygon.exterior
-                                        polygon_crossovers = polygon_lines.intersection(polygon_lines)
-                                        polygons = polygonize(polygon_crossovers)
-                                        valid_polygons = MultiPolygon(polygons)
-
-                                        # normalize area between the profiles to the pressure range
-                                        area = valid_polygons.area / pressure_range
-                                        data_range = (np.nanmax(df[cv].values) - np.nanmin(df[cv].values))
-
-                                        # Flag failed profiles
-                                        if area > data_range * hysteresis_thresholds['fail_threshold']:
-                                            flag = qartod.QartodFlags.FAIL
-                                            failed_files += 2
-                                        # Flag suspect profiles
-                                        elif area > data_range * hysteresis_thresholds['suspect_threshold']:
-                                            flag = qartod.QartodFlags.SUSPECT
-                                            suspect_files += 2
-                                        # Otherwise, both profiles are good
-                                        else:
-                                            flag = qartod.QartodFlags.GOOD
-                                        flag_vals[data_idx] = flag
-                                        flag_vals2[data_idx2] = flag
-
-                                    # save both .nc files with hysteresis flag applied
-                                    # (or flag values = UNKNOWN (2) if the profile depth range is <5 dbar)
-                                    save_ds(ds, flag_vals, attrs, qc_varname, ncfiles[i], cv)
-                                    save_ds(ds2, flag_vals2, attrs, qc_varname, f2, cv)
-                                    if 2. in flag_vals:
-                                        unknown_files += 2
-                                    skip += 1
-
-                                else:
-                                    # if there is no data left after QARTOD tests are applied, leave flag values UNKNOWN (2)
-                                    save_ds(ds, flag_vals, attrs, qc_varname, ncfiles[i], cv)
-                                    save_ds(ds2, flag_vals2, attrs, qc_varname, f2, cv)
-                                    unknown_files += 2
-                                    skip += 1
-                            else:
-                                # if timestamps are too far apart they're likely not from the same profile pair
-                                # leave flag values as UNKNOWN (2), set the attributes and save the .nc files
-                                save_ds(ds, flag_vals, attrs, qc_varname, ncfiles[i], cv)
-                                save_ds(ds2, flag_vals2, attrs, qc_varname, f2, cv)
-                                unknown_files += 2
-                                skip += 1
+                    unknown_files += unknown
+                    suspect_files += suspect
+                    failed_files += failed
 
             logging.info(' {:} unknown files found (of {:} total files)'.format(unknown_files, len(ncfiles)))
             logging.info(' {:} suspect files found (of {:} total files)'.format(suspect_files, len(ncfiles)))
@@ -339,33 +505,7 @@ if __name__ == '__main__':
     # ll = 'info'
     # level = 'sci'
     # main(deploy, mode, d, ll, level)
-    arg_parser = argparse.ArgumentParser(description=main.__doc__,
-                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-
-    arg_parser.add_argument('deployments',
-                            nargs='+',
-                            help='Glider deployment name(s) formatted as glider-YYYYmmddTHHMM')
-
-    arg_parser.add_argument('-m', '--mode',
-                            help='Deployment dataset status',
-                            choices=['rt', 'delayed'],
-                            default='rt')
-
-    arg_parser.add_argument('--level',
-                            choices=['sci', 'ngdac'],
-                            default='sci',
-                            help='Dataset type')
-
-    arg_parser.add_argument('-d', '--cdm_data_type',
-                            help='Dataset type',
-                            choices=['profile'],
-                            default='profile')
-
-    arg_parser.add_argument('-l', '--loglevel',
-                            help='Verbosity level',
-                            type=str,
-                            choices=['debug', 'info', 'warning', 'error', 'critical'],
-                            default='info')
+    arg_parser = build_arg_parser(description=main.__doc__)
 
     parsed_args = arg_parser.parse_args()
 
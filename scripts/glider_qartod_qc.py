@@ -7,10 +7,8 @@ Run ioos_qc QARTOD tests on processed glider NetCDF files and append the results
 """
 
 import os
-import argparse
 import sys
 from datetime import timedelta
-import glob
 import numpy as np
 import pandas as pd
 import xarray as xr
@@ -22,8 +20,8 @@ from ioos_qc.results import collect_results
 from ioos_qc.utils import load_config_as_dict as loadconfig
 from shapely.geometry import Point
 from shapely.geometry.polygon import Polygon
-from rugliderqc.common import find_glider_deployment_datapath, find_glider_deployments_rootdir
-from rugliderqc.loggers import logfile_basename, setup_logger, logfile_deploymentname
+from rugliderqc.common import find_glider_deployments_rootdir, setup_deployment, find_queue_ncfiles, build_arg_parser
+from rugliderqc.loggers import logfile_basename, setup_logger
 
 
 def build_global_regional_config(ds, qc_config_root):
@@ -146,25 +144,15 @@ def main(args):
         for deployment in args.deployments:
         # for deployment in [deployments]:
 
-            data_path, deployment_location = find_glider_deployment_datapath(logging_base, deployment, deployments_root,
-                                                                             dataset_type, cdm_data_type, mode)
-
+            data_path, deployment_location, logging = setup_deployment(logging_base, deployment, deployments_root,
+                                                                       dataset_type, cdm_data_type, mode, loglevel)
             if not data_path:
-                logging_base.error('{:s} data directory not found:'.format(deployment))
-                continue
-
-            if not os.path.isdir(os.path.join(deployment_location, 'proc-logs')):
-                logging_base.error('{:s} deployment proc-logs directory not found:'.format(deployment))
                 continue
 
-            logfilename = logfile_deploymentname(deployment, dataset_type, cdm_data_type, mode)
-            logFile = os.path.join(deployment_location, 'proc-logs', logfilename)
-            logging = setup_logger('logging', loglevel, logFile)
-
             logging.info('Running glider QARTOD QC: {:s}'.format(os.path.join(data_path, 'queue')))
 
             # List the netcdf files in queue
-            ncfiles = sorted(glob.glob(os.path.join(data_path, 'queue', '*.nc')))
+            ncfiles = find_queue_ncfiles(data_path)
 
             if len(ncfiles) == 0:
                 logging.error(' 0 files found to QC: {:s}'.format(os.path.join(data_path, 'queue')))
@@ -425,33 +413,7 @@ if __name__ == '__main__':
     # ll = 'info'
     # level = 'sci'
     # main(deploy, mode, d, ll, level)
-    arg_parser = argparse.ArgumentParser(description=main.__doc__,
-                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-
-    arg_parser.add_argument('deployments',
-                            nargs='+',
-                            help='Glider deployment name(s) formatted as glider-YYYYmmddTHHMM')
-
-    arg_parser.add_argument('-m', '--mode',
-                            help='Deployment dataset status',
-                            choices=['rt', 'delayed'],
-                            default='rt')
-
-    arg_parser.add_argument('--level',
-                            choices=['sci', 'ngdac'],
-                            default='sci',
-                            help='Dataset type')
-
-    arg_parser.add_argument('-d', '--cdm_data_type',
-                            help='Dataset type',
-                            choices=['profile'],
-                            default='profile')
-
-    arg_parser.add_argument('-l', '--loglevel',
-                            help='Verbosity level',
-                            type=str,
-                            choices=['debug', 'info', 'warning', 'error', 'critical'],
-                            default='info')
+    arg_parser = build_arg_parser(description=main.__doc__)
 
     parsed_args = arg_parser.parse_args()
 
@@ -7,12 +7,20 @@ Move quality controlled glider NetCDF files to the final data directory (out of
 """
 
 import os
-import argparse
 import sys
-import glob
-from pathlib import Path
-from rugliderqc.common import find_glider_deployment_datapath, find_glider_deployments_rootdir
-from rugliderqc.loggers import logfile_basename, setup_logger, logfile_deploymentname
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from rugliderqc.common import find_glider_deployments_rootdir, setup_deployment, find_queue_ncfiles, build_arg_parser
+from rugliderqc.loggers import logfile_basename, setup_logger
+
+
+def move_file(data_path, ncfile):
+    """
+    Move a netcdf file to the deployment data path (out of queue)
+    :param data_path: deployment netcdf data path
+    :param ncfile: netcdf file in queue
+    """
+    os.replace(ncfile, os.path.join(data_path, os.path.basename(ncfile)))
 
 
 def main(args):
@@ -36,35 +44,23 @@ def main(args):
         for deployment in args.deployments:
         # for deployment in [deployments]:
 
-            data_path, deployment_location = find_glider_deployment_datapath(logging_base, deployment, deployments_root,
-                                                                             dataset_type, cdm_data_type, mode)
-
+            data_path, deployment_location, logging = setup_deployment(logging_base, deployment, deployments_root,
+                                                                       dataset_type, cdm_data_type, mode, loglevel)
             if not data_path:
-                logging_base.error('{:s} data directory not found:'.format(deployment))
                 continue
 
-            if not os.path.isdir(os.path.join(deployment_location, 'proc-logs')):
-                logging_base.error('{:s} deployment proc-logs directory not found:'.format(deployment))
-                continue
-
-            logfilename = logfile_deploymentname(deployment, dataset_type, cdm_data_type, mode)
-            logFile = os.path.join(deployment_location, 'proc-logs', logfilename)
-            logging = setup_logger('logging', loglevel, logFile)
-
             # List the netcdf files in queue
-            ncfiles = sorted(glob.glob(os.path.join(data_path, 'queue', '*.nc')))
+            ncfiles = find_queue_ncfiles(data_path)
 
             if len(ncfiles) == 0:
                 logging.error(' 0 files found to move: {:s}'.format(os.path.join(data_path, 'queue')))
                 status = 1
                 continue
 
-            # Iterate through files and move them to the parent directory
-            moved = 0
-            for f in ncfiles:
-                p = Path(f).absolute()
-                p.rename(os.path.join(data_path, p.name))
-                moved += 1
+            # Move the files to the parent directory. Renames are only metadata operations that release the GIL
+            # (no netcdf library calls), so they are always done in parallel threads
+            with ThreadPoolExecutor(max_workers=args.workers or min(32, len(ncfiles))) as executor:
+                moved = sum(1 for _ in executor.map(partial(move_file, data_path), ncfiles))
 
             logging.info('Moved {:} of {:} valid netcdf files to: {:s}'.format(moved, len(ncfiles), data_path))
 
@@ -78,33 +74,7 @@ if __name__ == '__main__':
     # ll = 'info'
     # level = 'sci'
     # main(deploy, mode, d, ll, level)
-    arg_parser = argparse.ArgumentParser(description=main.__doc__,
-                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-
-    arg_parser.add_argument('deployments',
-                            nargs='+',
-                            help='Glider deployment name(s) formatted as glider-YYYYmmddTHHMM')
-
-    arg_parser.add_argument('-m', '--mode',
-                            help='Deployment dataset status',
-                            choices=['rt', 'delayed'],
-                            default='rt')
-
-    arg_parser.add_argument('--level',
-                            choices=['sci', 'ngdac'],
-                            default='sci',
-                            help='Dataset type')
-
-    arg_parser.add_argument('-d', '--cdm_data_type',
-                            help='Dataset type',
-                            choices=['profile'],
-                            default='profile')
-
-    arg_parser.add_argument('-l', '--loglevel',
-                            help='Verbosity level',
-                            type=str,
-                            choices=['debug', 'info', 'warning', 'error', 'critical'],
-                            default='info')
+    arg_parser = build_arg_parser(description=main.__doc__)
 
     parsed_args = arg_parser.parse_args()
 
@@ -4,44 +4,239 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 import os
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+matplotlib.use('Agg')  # plots are only saved to files, render without a display
 import matplotlib.pyplot as plt
-plt.rcParams.update({'font.size': 12})
+from matplotlib.collections import LineCollection
+plt.rcParams.update({'font.size': 12, 'path.simplify': True, 'path.simplify_threshold': 1.0})
 
 
+_MARKERS = dict(climatology=dict(m='v', s=60, alpha=1),
+                hysteresis=dict(m='s', s=40, alpha=1),
+                flat_line=dict(m='^', s=60, alpha=1),
+                gross_range=dict(m='D', s=40, alpha=1),
+                rate_of_change=dict(m='X', s=80, alpha=1),
+                spike=dict(m='*', s=100, alpha=1),
+                summary=dict(m='o', s=100, alpha=.5)
+                )
+
+# qc flag values plotted, and their colors
+_FLAG_DEFS = dict(unknown=dict(value=2, color='cyan'),
+                  suspect=dict(value=3, color='orange'),
+                  fail=dict(value=4, color='red'))
+_FLAG_VALUES = [info['value'] for info in _FLAG_DEFS.values()]
+
+
+@lru_cache(maxsize=None)
 def define_markers(qc_varname):
-    markers = dict(climatology=dict(m='v', s=60, alpha=1),
-                   hysteresis=dict(m='s', s=40, alpha=1),
-                   flat_line=dict(m='^', s=60, alpha=1),
-                   gross_range=dict(m='D', s=40, alpha=1),
-                   rate_of_change=dict(m='X', s=80, alpha=1),
-                   spike=dict(m='*', s=100, alpha=1),
-                   summary=dict(m='o', s=100, alpha=.5)
-                   )
-    mkey = [key for key in markers.keys() if key in qc_varname][0]
-    return markers[mkey]
+    # the same few qc variable names are looked up for every plot, so only match each name once
+    mkey = next(key for key in _MARKERS.keys() if key in qc_varname)
+    return _MARKERS[mkey]
 
 
-def main(deploy, fname, nprof):
-    glider = deploy.split('-')[0]
+# plot data arrays shared with the worker processes by _init_worker, and the figure reused for each plot in the worker
+_DATA = None
+_FIG = None
+
 
+def load_dataset(fname, ctd_vars):
+    """
+    Load the variables that are plotted (and their qc variables) into memory, sorted by time
+    :param fname: netcdf file
+    :param ctd_vars: ctd variables to plot
+    """
     ds = xr.open_dataset(fname)
     ds = ds.swap_dims({'row': 'time'})
-    ds = ds.sortby(ds.time)
+
+    # read only the variables that are plotted (and their qc variables) into memory once, before sorting, instead of
+    # reading them from the file for every plot section
+    keep_vars = ['profile_time', 'pressure'] + ctd_vars
+    keep_vars += [x for x in ds.data_vars if any(f'{cv}_' in x for cv in ctd_vars) and x not in keep_vars]
+    ds = ds[[x for x in keep_vars if x in ds.variables]].load()
+    return ds.sortby(ds.time)
+
+
+def profile_edges(prof_time, pressure):
+    """
+    Find the start/end index of each profile in a section sorted by profile_time (each profile is a contiguous slice
+    of the section), and where pressure isn't NaN. Returns (edges, pressure mask), profile i is
+    edges[i]:edges[i + 1].
+    :param prof_time: profile_time values of the section
+    :param pressure: pressure values of the section
+    """
+    edges = np.concatenate(([0], np.flatnonzero(prof_time[1:] != prof_time[:-1]) + 1, [len(prof_time)]))
+    return edges, ~np.isnan(pressure)
+
+
+def profile_segments(data, pressure, edges, keep):
+    """
+    Build the (data, pressure) line segment of each profile, only using the rows where keep is True. The rows are
+    gathered for the whole section at once and split at the profile edges shifted to the kept rows, instead of
+    indexing each profile separately.
+    :param data: data values of the section
+    :param pressure: pressure values of the section
+    :param edges: profile edges from profile_edges
+    :param keep: boolean mask of the rows to use
+    """
+    kept_edges = np.concatenate(([0], np.cumsum(keep)))[edges[1:-1]]
+    return np.split(np.column_stack([data[keep], pressure[keep]]), kept_edges)
+
+
+def _init_worker(data):
+    # the data arrays are loaded once by main, the workers only index into them and never reopen the file. With the
+    # fork start method the arrays are shared with the parent process instead of being copied
+    global _DATA
+    _DATA = data
+
+
+def _render_section(task):
+    """
+    Plot each ctd variable and its qc flags for one section of profiles
+    :param task: (glider, lo, hi, ctd_vars, savedir), where lo and hi are the time indices of the section
+    """
+    global _FIG
+    glider, lo, hi, ctd_vars, savedir = task
+
+    # reuse one figure for all of the plots made by the worker instead of creating and closing one for each plot
+    if _FIG is None:
+        _FIG = plt.figure(figsize=(8, 10))
+        _FIG.add_subplot(111)
+    fig = _FIG
+    ax = fig.axes[0]
+
+    section = {name: values[lo:hi] for name, values in _DATA.items()}
+    prof_time = section['profile_time']
+
+    # the section is sorted by profile_time, so the first and last values are the min and max. The time strings
+    # are the same for all of the ctd variable plots
+    t0 = pd.Timestamp(prof_time[0])
+    t1 = pd.Timestamp(prof_time[-1])
+    t0str = t0.strftime('%Y-%m-%dT%H:%M')
+    t1str = t1.strftime('%Y-%m-%dT%H:%M')
+    t0save = t0.strftime('%Y%m%dT%H%M')
+    t1save = t1.strftime('%Y%m%dT%H%M')
+    ttl = f'{glider} {t0str} to {t1str}'
+
+    # find the profile edges once per section and reuse them (and the mask of the rows where pressure isn't NaN) for
+    # all of the ctd variables
+    press_v = section['pressure']
+    edges, pmask = profile_edges(prof_time, press_v)
+
+    # qc variables found in the dataset, the hysteresis test variables aren't always there
+    present_set = set(section)
+
+    # the hysteresis test variables are plotted with more than one ctd variable, so keep the flag value masks of each
+    # qc variable for the whole section instead of comparing the flag values again for each plot
+    flag_mask_cache = dict()
+    for cv in ctd_vars:
+        save_filename = f'{cv}_qc_{t0save}-{t1save}.png'
+
+        ax.clear()
+
+        # build the profile lines as one collection instead of plotting each profile separately
+        # drop the rows where either pressure or the data are NaN
+        data_v = section[cv]
+        segments = profile_segments(data_v, press_v, edges, pmask & ~np.isnan(data_v))
+        lc = LineCollection(segments, colors='gray', linewidths=plt.rcParams['lines.linewidth'], zorder=2)
+        ax.add_collection(lc)  # plot lines
+
+        # add points. Large sections are drawn as the markers of a single line instead of a scatter, which skips
+        # the per-point color and size handling
+        if len(data_v) > 50000:
+            ax.plot(data_v, press_v, linestyle='none', marker='o', markersize=np.sqrt(20), color='gray', zorder=5)
+        else:
+            ax.scatter(data_v, press_v, color='gray', s=20, zorder=5)
+
+        # find the qc variables
+        qc_vars = [x for x in section if f'{cv}_' in x]
+        if cv in ['salinity', 'density']:
+            qc_vars.append('conductivity_hysteresis_test')
+            qc_vars.append('temperature_hysteresis_test')
+        qc_vars = [qv for qv in qc_vars if qv in present_set]
+
+        # group the flag values of the qc variables by marker, so each flag value is plotted with one
+        # scatter per marker instead of one per qc variable
+        marker_groups = dict()
+        for qi, qv in enumerate(qc_vars):
+            masks = dict()
+            for value in _FLAG_VALUES:
+                key = (qv, value)
+                if key not in flag_mask_cache:
+                    flag_mask_cache[key] = section[qv] == value
+                masks[value] = flag_mask_cache[key]
+            if not any(mask.any() for mask in masks.values()):
+                continue
+            m_defs = define_markers(qv)
+            group = marker_groups.setdefault(m_defs['m'], dict(m_defs=m_defs, qc_vars=[], masks=[]))
+            group['qc_vars'].append(qv)
+            group['masks'].append(masks)
+
+        for group in marker_groups.values():
+            m_defs = group['m_defs']
+            for fd, info in _FLAG_DEFS.items():
+                # only combine (and name in the legend) the qc variables that have this flag value
+                flagged = [(qv, masks[info['value']]) for qv, masks in zip(group['qc_vars'], group['masks'])
+                           if masks[info['value']].any()]
+                if flagged:
+                    qc_mask = np.logical_or.reduce([mask for qv, mask in flagged])
+                    ax.scatter(data_v[qc_mask], press_v[qc_mask], color=info['color'], s=m_defs['s'],
+                               marker=m_defs['m'], edgecolor='k', alpha=m_defs['alpha'],
+                               label=f"{'/'.join(qv for qv, mask in flagged)}-{fd}", zorder=10)
+
+        # add legend if necessary
+        handles, labels = ax.get_legend_handles_labels()
+        by_label = dict(zip(labels, handles))
+        if len(handles) > 0:
+            ax.legend(by_label.values(), by_label.keys(), loc='best')
+
+        ax.invert_yaxis()
+        ax.set_ylabel('Pressure (dbar)')
+        ax.set_xlabel(f'{cv}')
+        ax.set_title(ttl)
+
+        sfile = os.path.join(savedir, save_filename)
+        # the plots are for reviewing the qc flags, so save at a lower dpi with fast (low) png compression
+        fig.savefig(sfile, dpi=150, pil_kwargs={'compress_level': 1})
+
+
+def main(deploy, fname, nprof):
+    glider = deploy.split('-')[0]
+
+    ctd_vars = ['conductivity', 'temperature', 'salinity', 'density']
+
+    ds = load_dataset(fname, ctd_vars)
+
+    # plot from plain numpy arrays, the workers don't need to touch xarray or the netcdf file
+    data = dict(profile_time=ds.profile_time.values, pressure=ds.pressure.values)
+    data.update({x: ds[x].values for x in ds.data_vars if x not in data})
+
+    # store the ctd variables as rows of one float32 block, halving the bytes read for each plot. This isn't
+    # lossless, float32 keeps ~7 significant digits, which is more than the plots can show
+    ctd_block = np.stack([data[cv] for cv in ctd_vars]).astype(np.float32)
+    data.update({cv: ctd_block[i] for i, cv in enumerate(ctd_vars)})
+    data['pressure'] = data['pressure'].astype(np.float32)
+
+    # flag values fit in int8, read as floats the fill values are NaN so set them to MISSING (9) before casting
+    for qv in [x for x in data if any(f'{cv}_' in x for cv in ctd_vars)]:
+        flag_vals = data[qv]
+        if np.issubdtype(flag_vals.dtype, np.floating):
+            flag_vals = np.where(np.isnan(flag_vals), 9, flag_vals)
+        data[qv] = flag_vals.astype(np.int8)
 
     savedir = os.path.join('/Users/garzio/Documents/rucool/gliders/qartod_qc/from_erddap/plots', deploy, f'profiles_group{nprof}')
     os.makedirs(savedir, exist_ok=True)
 
-    profiletimes = np.unique(ds.profile_time.values)
+    # profile_time increases with time once the dataset is sorted by time, so the rows of each plot section can be
+    # found with a binary search instead of scanning the full arrays for every section
+    pt_all = data['profile_time']
+    profiletimes = np.unique(pt_all)
 
     plot_sections = np.arange(0, len(profiletimes), nprof)
     plot_sections = np.append(plot_sections, len(profiletimes))
 
-    ctd_vars = ['conductivity', 'temperature', 'salinity', 'density']
-
-    flag_defs = dict(unknown=dict(value=2, color='cyan'),
-                     suspect=dict(value=3, color='orange'),
-                     fail=dict(value=4, color='red'))
-
+    tasks = []
     for ps_idx, ps in enumerate(plot_sections):
         if ps_idx > 0:
             if ps_idx == 1:
@@ -49,64 +244,17 @@ def main(deploy, fname, nprof):
             else:
                 ii = plot_sections[ps_idx - 1] + 1
             ptimes = profiletimes[ii:ps]
-            ptimes_idx = np.where(np.logical_and(ds.profile_time >= ptimes[0], ds.profile_time <= ptimes[-1]))[0]
-            time0 = np.nanmin(ds.time.values[ptimes_idx])
-            time1 = np.nanmax(ds.time.values[ptimes_idx])
-            dss = ds.sel(time=slice(time0, time1))
-            t0str = pd.to_datetime(np.nanmin(dss.profile_time.values)).strftime('%Y-%m-%dT%H:%M')
-            t1str = pd.to_datetime(np.nanmax(dss.profile_time.values)).strftime('%Y-%m-%dT%H:%M')
-            t0save = pd.to_datetime(np.nanmin(dss.profile_time.values)).strftime('%Y%m%dT%H%M')
-            t1save = pd.to_datetime(np.nanmax(dss.profile_time.values)).strftime('%Y%m%dT%H%M')
-            for cv in ctd_vars:
-                save_filename = f'{cv}_qc_{t0save}-{t1save}.png'
-
-                data = dss[cv]
-                pressure = dss.pressure
-                fig, ax = plt.subplots(figsize=(8, 10))
-
-                # iterate through each profile and plot the profile lines
-                for pt in ptimes:
-                    pt_idx = np.where(dss.profile_time.values == pt)[0]
-                    non_nans = np.where(np.invert(np.isnan(pressure[pt_idx])))[0]
-                    ax.plot(data[pt_idx][non_nans], pressure[pt_idx][non_nans], color='gray')  # plot lines
-
-                # add points
-                ax.scatter(data, pressure, color='gray', s=20, zorder=5)
-
-                # find the qc variables
-                qc_vars = [x for x in ds.data_vars if f'{cv}_' in x]
-                if cv in ['salinity', 'density']:
-                    qc_vars.append('conductivity_hysteresis_test')
-                    qc_vars.append('temperature_hysteresis_test')
-
-                for qi, qv in enumerate(qc_vars):
-                    try:
-                        flag_vals = dss[qv].values
-                    except KeyError:
-                        continue
-                    for fd, info in flag_defs.items():
-                        qc_idx = np.where(flag_vals == info['value'])[0]
-                        if len(qc_idx) > 0:
-                            m_defs = define_markers(qv)
-                            ax.scatter(data[qc_idx], pressure[qc_idx], color=info['color'], s=m_defs['s'],
-                                       marker=m_defs['m'], edgecolor='k', alpha=m_defs['alpha'],
-                                       label=f'{qv}-{fd}', zorder=10)
-
-                # add legend if necessary
-                handles, labels = plt.gca().get_legend_handles_labels()
-                by_label = dict(zip(labels, handles))
-                if len(handles) > 0:
-                    ax.legend(by_label.values(), by_label.keys(), loc='best')
-
-                ax.invert_yaxis()
-                ax.set_ylabel('Pressure (dbar)')
-                ax.set_xlabel(f'{cv}')
-                ttl = f'{glider} {t0str} to {t1str}'
-                ax.set_title(ttl)
-
-                sfile = os.path.join(savedir, save_filename)
-                plt.savefig(sfile, dpi=300)
-                plt.close()
+            lo = np.searchsorted(pt_all, ptimes[0], side='left')
+            hi = np.searchsorted(pt_all, ptimes[-1], side='right')
+            tasks.append((glider, lo, hi, ctd_vars, savedir))
+
+    # each section is plotted independently, render them in parallel processes. Only start as many workers as there
+    # are sections, with the spawn start method (macOS) each worker gets its own copy of the data arrays
+    if len(tasks) == 0:
+        return
+    with ProcessPoolExecutor(max_workers=min(os.cpu_count(), len(tasks)), initializer=_init_worker,
+                             initargs=(data,)) as executor:
+        list(executor.map(_render_section, tasks))
 
 
 if __name__ == '__main__':